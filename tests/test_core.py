@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-import importlib
+from datetime import date
 from pathlib import Path
 
+import pandas as pd
 import pytest
 from freezegun import freeze_time
 
@@ -14,13 +15,26 @@ OUTPUTS = FILES / "outputs"
 
 
 @pytest.fixture
-def command(capsys):
+def command(capsys, monkeypatch, tmp_path):
+    # Don't touch the user's own cache directory (if diskcache is installed).
+    monkeypatch.setattr(tefas_ui, "CACHE_DIR", tmp_path / "cache")
+    tefas_ui.get_cache.cache_clear()
+
     def runner(*args):
-        module = importlib.reload(tefas_ui)
-        module.main(argv=[str(arg) for arg in args])
+        # The in-memory fallbacks of the on-disk caches have to be reset.
+        for cached_func in [
+            tefas_ui.get_crawler,
+            tefas_ui.fetch_window,
+            tefas_ui.fx_rate.func,
+        ]:
+            if hasattr(cached_func, "cache_clear"):
+                cached_func.cache_clear()
+
+        tefas_ui.main(argv=[str(arg) for arg in args])
         return capsys.readouterr().out
 
-    return runner
+    yield runner
+    tefas_ui.get_cache.cache_clear()
 
 
 @freeze_time("2021-12-22")
@@ -52,3 +66,194 @@ def test_basic_operations_weekend(
 
     result = command("--currency", currency, input_file, format)
     assert result == output_file.read_text()
+
+
+def make_fund(buys, sells=()):
+    return tefas_ui.Fund(
+        "TYH",
+        buys=[
+            tefas_ui.Action(tefas_ui.ActionKind.BUY, date(2021, 12, day), shares, 1.0)
+            for day, shares in enumerate(buys, 1)
+        ],
+        sells=[
+            tefas_ui.Action(tefas_ui.ActionKind.SELL, date(2021, 12, 20), shares, 2.0)
+            for shares in sells
+        ],
+    )
+
+
+@pytest.mark.parametrize(
+    "buys, sells, remaining",
+    [
+        ([5, 3, 4], [], [5, 3, 4]),
+        ([5, 3, 4], [6, 1], [0, 1, 4]),
+        ([5, 3, 4], [2], [3, 3, 4]),
+        ([5, 3], [5, 3], [0, 0]),
+        ([5, 3], [8], [0, 0]),
+    ],
+)
+def test_fifo_deduct(buys, sells, remaining):
+    assert tefas_ui._fifo_deduct(buys, sells) == remaining
+
+
+@pytest.mark.parametrize(
+    "buys, sells",
+    [
+        ([5, 3], [9]),
+        ([5, 3], [5, 3, 1]),
+        ([], [1]),
+    ],
+)
+def test_fifo_deduct_oversell(buys, sells):
+    with pytest.raises(ValueError):
+        tefas_ui._fifo_deduct(buys, sells)
+
+
+def test_deduct_sales():
+    fund = make_fund([5, 3, 4], [6, 1])
+    new_fund = fund.deduct_sales()
+
+    assert not new_fund.sells
+    assert [(buy.date.day, buy.num_shares) for buy in new_fund.buys] == [(2, 1), (3, 4)]
+    # The original fund is left untouched.
+    assert [buy.num_shares for buy in fund.buys] == [5, 3, 4]
+
+
+def test_deduct_sales_exhausted():
+    fund = make_fund([5, 3], [5, 3])
+    assert not fund.deduct_sales().buys
+    assert list(tefas_ui.drop_sold_funds([fund])) == []
+
+
+def test_deduct_sales_only_sells():
+    fund = make_fund([], [3])
+    with pytest.raises(ValueError):
+        fund.deduct_sales()
+
+
+TEB_LINE = "{date}\t{name}\t{kind}\tCEPTETEB\tXXXX\t{shares}\t{price}\tTL\tXXXXX"
+
+
+@pytest.mark.parametrize(
+    "line, key, action",
+    [
+        (
+            TEB_LINE.format(
+                date="14/09/2021",
+                name="TYH-HİSSE YOĞUN",
+                kind="Alış",
+                shares="100,00",
+                price="0,150104",
+            ),
+            "TYH",
+            tefas_ui.Action(tefas_ui.ActionKind.BUY, date(2021, 9, 14), 100, 0.150104),
+        ),
+        (
+            TEB_LINE.format(
+                date="1/2/2021",
+                name="TPL-EUROBOND - DÖVİZ",
+                kind="Satış",
+                shares="1.200,00",
+                price="2,889543",
+            ),
+            "TPL",
+            tefas_ui.Action(tefas_ui.ActionKind.SELL, date(2021, 2, 1), 1200, 2.889543),
+        ),
+    ],
+)
+def test_teb_iter_actions(line, key, action):
+    assert list(tefas_ui.Teb().iter_actions([line + "\n"])) == [(key, action)]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "",
+        "14/09/2021\tTYH-HİSSE YOĞUN\tAlış",
+        TEB_LINE.format(
+            date="2021-09-14",
+            name="TYH-HİSSE YOĞUN",
+            kind="Alış",
+            shares="100,00",
+            price="0,150104",
+        ),
+        TEB_LINE.format(
+            date="14/09/2021",
+            name="HİSSE YOĞUN",
+            kind="Alış",
+            shares="100,00",
+            price="0,150104",
+        ),
+    ],
+)
+def test_teb_iter_actions_malformed(line):
+    with pytest.raises(ValueError, match="Can't parse line"):
+        list(tefas_ui.Teb().iter_actions([line]))
+
+
+def test_teb_process():
+    input_file = INPUTS / "teb.txt"
+    with open(input_file) as stream:
+        from_stream = tefas_ui.Teb().process_stream(stream)
+    from_string = tefas_ui.Teb().process(input_file.read_text())
+
+    assert from_stream == from_string
+    assert [fund.key for fund in from_stream] == ["TYH", "TPL", "TMG", "TKM"]
+    for fund in from_stream:
+        assert all(buy.kind is tefas_ui.ActionKind.BUY for buy in fund.buys)
+        assert all(sell.kind is tefas_ui.ActionKind.SELL for sell in fund.sells)
+        dates = [action.date for action in fund.buys]
+        assert dates == sorted(dates)
+
+
+class FakeCache(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+    def set(self, key, value, expire=None):
+        self[key] = value
+
+
+@pytest.fixture
+def disk_fetch_window(monkeypatch):
+    cache = FakeCache()
+    monkeypatch.setattr(tefas_ui, "HAS_DISKCACHE", True)
+    monkeypatch.setattr(tefas_ui, "get_cache", lambda: cache)
+    fetch_window = tefas_ui.memoize(expire=60)(tefas_ui.fetch_window.__wrapped__)
+    return cache, fetch_window
+
+
+def stub_crawler(monkeypatch, data):
+    calls = []
+
+    class Crawler:
+        def fetch(self, **kwargs):
+            calls.append(kwargs)
+            return data
+
+    monkeypatch.setattr(tefas_ui, "get_crawler", Crawler)
+    return calls
+
+
+def test_fetch_window_cached(monkeypatch, disk_fetch_window):
+    cache, fetch_window = disk_fetch_window
+    data = pd.DataFrame({"price": [1.0], "title": ["T"], "date": [date(2021, 12, 22)]})
+    calls = stub_crawler(monkeypatch, data)
+
+    first = fetch_window("TYH", "2021-12-14", "2021-12-22", ("price", "title", "date"))
+    second = fetch_window("TYH", "2021-12-14", "2021-12-22", ("price", "title", "date"))
+    assert len(calls) == 1
+    assert len(cache) == 1
+    pd.testing.assert_frame_equal(first, data)
+    pd.testing.assert_frame_equal(second, data)
+
+
+def test_fetch_window_empty_response(monkeypatch, disk_fetch_window):
+    cache, fetch_window = disk_fetch_window
+    calls = stub_crawler(monkeypatch, pd.DataFrame(columns=["price", "title", "date"]))
+
+    for _ in range(2):
+        with pytest.raises(ValueError, match="No data returned"):
+            fetch_window("TYH", "2021-12-14", "2021-12-22", ("price", "title", "date"))
+    assert len(calls) == 2
+    assert not cache